@@ -1,8 +1,14 @@
 import os
+import hashlib
+import inspect
+import pickle
+import warnings
+import weakref
+from collections import deque
+from contextlib import contextmanager
 import torch
 import torch.nn as nn
 from functorch import make_functional_with_buffers, make_fx
-from torch.fx.node import map_arg
 import torch.fx as fx
 from torch.fx.proxy import GraphAppendingTracer
 from torch.fx import immutable_collections
@@ -11,15 +17,67 @@ import torch.utils.dlpack
 from torch.fx.passes import graph_drawer
 from functorch._C import CompileCache
 from .python_key import pythonkey_decompose
-from .decompositions import register_decomposition
+from .decompositions import register_decomposition, decomposition_table
 
-pytree._register_pytree_node(immutable_collections.immutable_list, lambda x: (
-    list(x), None), lambda x, c: immutable_collections.immutable_list(x))
-pytree._register_pytree_node(immutable_collections.immutable_dict, lambda x: (list(x.values()), list(
-    x.keys())), lambda x, c: immutable_collections.immutable_dict({key: value for key, value in zip(c, x)}))
+
+def _register_immutable_pytree_nodes():
+    if hasattr(pytree, "register_pytree_node"):
+        register_pytree_node = pytree.register_pytree_node
+    else:
+        register_pytree_node = pytree._register_pytree_node
+    nodes = [
+        (immutable_collections.immutable_list, lambda x: (list(x), None),
+         lambda x, c: immutable_collections.immutable_list(x)),
+        (immutable_collections.immutable_dict, lambda x: (list(x.values()), list(x.keys())),
+         lambda x, c: immutable_collections.immutable_dict({key: value for key, value in zip(c, x)})),
+    ]
+    # Newer versions of PyTorch already register these, and reject registering them twice
+    for typ, flatten_fn, unflatten_fn in nodes:
+        if typ not in pytree.SUPPORTED_NODES:
+            register_pytree_node(typ, flatten_fn, unflatten_fn)
+
+
+_register_immutable_pytree_nodes()
 
 aten = torch.ops.aten
 
+# Linting the partitioned graphs is a full pass over them, so it's only done when debugging
+_AOT_LINT = os.getenv("AOT_LINT") == "1"
+
+
+# These decompositions shouldn't always be used, so they are kept out of the
+# global decomposition_table and only applied while tracing the joint graph.
+aot_autograd_decompositions = {}
+
+
+# Kinda sketchy ... we use torch.sub here to have the correct scalar => tensor promotion logic
+@register_decomposition(aten.rsub, aot_autograd_decompositions)
+def rsub(a, b, alpha=1):
+    return -aten.sub(a, b)
+
+
+# This is only valid if we're running the graph without autograd, such as if the backward pass has been traced.
+@register_decomposition(aten.detach, aot_autograd_decompositions)
+def detach_decomposition(x):
+    return x
+
+
+@contextmanager
+def _aot_autograd_decompose():
+    replaced = {op: decomposition_table[op] for op in aot_autograd_decompositions if op in decomposition_table}
+    decomposition_table.update(aot_autograd_decompositions)
+    try:
+        with pythonkey_decompose():
+            yield
+    finally:
+        for op in aot_autograd_decompositions:
+            del decomposition_table[op]
+        decomposition_table.update(replaced)
+
+
+# Ops whose outputs partition_with_recompute_fwd_in_bwd saves instead of recomputes
+RANDOM_OPS = frozenset([aten.rand_like])
+
 
 def draw_graph(traced: torch.fx.GraphModule, fname: str, figname: str = "fx_graph"):
     base, ext = os.path.splitext(fname)
@@ -34,30 +92,24 @@ def draw_graph(traced: torch.fx.GraphModule, fname: str, figname: str = "fx_grap
 
 
 def default_partition(fx_module: fx.GraphModule, _joint_inputs):
+    # A node goes in the backward if it uses a tangent, a backward node, or a
+    # value that is already saved for the backward. The latter lets cheap ops
+    # on saved values be recomputed in the backward instead of saving their
+    # outputs too.
     bw_nodes = set()
     saved_nodes = set()
     output_node = None
     for n in fx_module.graph.nodes:
-        if n.op == 'placeholder' and 'tangents' in n.target:
+        if n.op == 'placeholder' and n.target.startswith('tangents'):
             bw_nodes.add(n)
         elif n.op != 'output':
-            has_color = False
-
-            def is_colored(a):
-                nonlocal has_color
-                if a in bw_nodes or a in saved_nodes:
-                    has_color = True
-
-            def add_saved(a):
-                if a not in bw_nodes:
-                    saved_nodes.add(a)
-            map_arg(n.args, lambda x: is_colored(x))
-            map_arg(n.kwargs, lambda x: is_colored(x))
-            if has_color:
+            inputs = n.all_input_nodes
+            if any(a in bw_nodes or a in saved_nodes for a in inputs):
                 bw_nodes.add(n)
-                map_arg(n.args, lambda x: add_saved(x))
-                map_arg(n.kwargs, lambda x: add_saved(x))
-        elif n.op == 'output':
+                for a in inputs:
+                    if a not in bw_nodes:
+                        saved_nodes.add(a)
+        else:
             output_node = n
 
     num_fwd_outputs = fx_module._out_spec.children_specs[0].num_leaves
@@ -69,8 +121,9 @@ def default_partition(fx_module: fx.GraphModule, _joint_inputs):
     for saved_node in saved_nodes:
         value_remap[saved_node] = bw_graph.placeholder(saved_node.name)
 
+    bw_output_set = set(bw_outputs)
     for node in fx_module.graph.nodes:
-        if node in bw_nodes or node in bw_outputs:
+        if node in bw_nodes or node in bw_output_set:
             value_remap[node] = bw_graph.node_copy(node, lambda n: value_remap[n])
 
     assert(num_fwd_outputs + num_bwd_outputs == len(output_node.args[0]))
@@ -92,8 +145,9 @@ def default_partition(fx_module: fx.GraphModule, _joint_inputs):
         fwd_outputs = fwd_outputs[0]
     fw_graph.output(fwd_outputs)
     fw_module = fx.GraphModule(fx_module, fw_graph)
-    fw_module.graph.lint()
-    bw_module.graph.lint()
+    if _AOT_LINT:
+        fw_module.graph.lint()
+        bw_module.graph.lint()
     return fw_module, bw_module
 
 
@@ -123,27 +177,43 @@ def _extract_graph_with_inputs_outputs(joint_graph, inputs, outputs):
     new_inputs = {}
     for node in inputs:
         new_node = new_graph.placeholder(node.name)
-        new_inputs[node.name] = new_node
+        new_inputs[node] = new_node
+
+    # Maps the nodes in x to their proxies, returning InvalidNode as soon as
+    # one of them is invalid.
+    def map_arg_to_proxy(x):
+        if isinstance(x, fx.Node):
+            return env[x]
+        elif isinstance(x, (list, tuple)):
+            out = []
+            for a in x:
+                a = map_arg_to_proxy(a)
+                if a is InvalidNode:
+                    return InvalidNode
+                out.append(a)
+            return type(x)(out)
+        elif isinstance(x, dict):
+            out = {}
+            for k, v in x.items():
+                v = map_arg_to_proxy(v)
+                if v is InvalidNode:
+                    return InvalidNode
+                out[k] = v
+            return type(x)(out)
+        else:
+            return x
 
     for node in joint_graph.nodes:
-        if node in inputs:
-            env[node] = fx.Proxy(new_inputs[node.name], tracer)
+        if node in new_inputs:
+            env[node] = fx.Proxy(new_inputs[node], tracer)
         elif node.op == 'placeholder':
             env[node] = InvalidNode
         elif node.op == 'call_function':
-            def map_arg_to_proxy(x):
-                if isinstance(x, fx.Node):
-                    out = env[x]
-                    return out
-                else:
-                    return x
-            all_args = pytree.tree_flatten((node.args, node.kwargs))[0]
-            all_args = [isinstance(env[x], InvalidNodeBase) for x in all_args if isinstance(x, fx.Node)]
-            if any(all_args):
+            node_args = map_arg_to_proxy((node.args, node.kwargs))
+            if node_args is InvalidNode:
                 env[node] = InvalidNode
                 continue
-            args = pytree.tree_map(map_arg_to_proxy, node.args)
-            kwargs = pytree.tree_map(map_arg_to_proxy, node.kwargs)
+            args, kwargs = node_args
             out = node.target(*args, **kwargs)
             env[node] = out
         elif node.op == 'get_attr':
@@ -154,7 +224,8 @@ def _extract_graph_with_inputs_outputs(joint_graph, inputs, outputs):
     new_graph.output([env[x].node for x in outputs])
 
     new_graph.eliminate_dead_code()
-    new_graph.lint()
+    if _AOT_LINT:
+        new_graph.lint()
     return new_graph
 
 
@@ -167,45 +238,52 @@ def partition_with_recompute_fwd_in_bwd(joint_module: fx.GraphModule, _joint_inp
     outputs to just original forward or backward outputs. And then we run the
     resulting graphs through dead code elimintation.
     """
-
-    def is_primal(node):
-        return node.op == "placeholder" and "tangents" not in node.target
-
-    def is_tangent(node):
-        return node.op == "placeholder" and "tangents" in node.target
     nodes = joint_module.graph.nodes
     num_fwd_outputs = joint_module._out_spec.children_specs[0].num_leaves
-    outputs = pytree.tree_flatten([node.args for node in nodes if node.op == 'output'])[0]
+    # The output node comes last, and its args are already flat
+    output_node = next(node for node in reversed(nodes) if node.op == 'output')
+    outputs = list(output_node.args[0])
     fwd_outputs = outputs[:num_fwd_outputs]
     bwd_outputs = outputs[num_fwd_outputs:]
 
-    saved_values = list(filter(is_primal, nodes))
-
-    random_ops = set([torch.ops.aten.rand_like])
-    random_nodes = list(filter(lambda x: x.target in random_ops, nodes))
+    primal_inputs = []
+    tangent_inputs = []
+    for node in nodes:
+        if node.op == 'placeholder':
+            if node.target.startswith('tangents'):
+                tangent_inputs.append(node)
+            else:
+                primal_inputs.append(node)
+    # Without a backward pass (e.g. when no input requires grad) nothing is
+    # saved or recomputed, so skip extracting an empty backward graph.
+    if not tangent_inputs or not bwd_outputs:
+        return default_partition(joint_module, _joint_inputs)
+
+    saved_values = list(primal_inputs)
+
+    for node in nodes:
+        if node.target in RANDOM_OPS:
+            saved_values.append(node)
+
+    # Filter out saved values that don't actually end up being used by the
+    # backwards pass, i.e. the ones that can't be reached from the backward
+    # outputs without going through another saved value.
+    saved_value_set = set(saved_values)
+    bw_reachable = set()
+    queue = deque(n for n in bwd_outputs if isinstance(n, fx.Node))
+    while queue:
+        n = queue.popleft()
+        if n in bw_reachable:
+            continue
+        bw_reachable.add(n)
+        if n not in saved_value_set:
+            queue.extend(n.all_input_nodes)
+    saved_values = [s for s in saved_values if s in bw_reachable]
 
-    for node in random_nodes:
-        saved_values.append(node)
-
-    primal_inputs = list(filter(is_primal, joint_module.graph.nodes))
-    tangent_inputs = list(filter(is_tangent, joint_module.graph.nodes))
     # Construct the forward module
     fwd_graph = _extract_graph_with_inputs_outputs(joint_module.graph, primal_inputs, fwd_outputs + saved_values)
     bwd_graph = _extract_graph_with_inputs_outputs(joint_module.graph, saved_values + tangent_inputs, bwd_outputs)
 
-    # This is to filter out saved values that don't actually end up being used by the backwards pass
-    for node in bwd_graph.nodes:
-        if node.op == 'placeholder' and not node.users:
-            for saved_value in saved_values:
-                if saved_value.name == node.name:
-                    saved_values.remove(saved_value)
-                    break
-
-    # Now, we re-generate the fwd/bwd graphs.
-    # NB: This might increase compilation time, but I doubt it matters
-    fwd_graph = _extract_graph_with_inputs_outputs(joint_module.graph, primal_inputs, fwd_outputs + saved_values)
-    bwd_graph = _extract_graph_with_inputs_outputs(joint_module.graph, saved_values + tangent_inputs, bwd_outputs)
-
     fwd_module = fx.GraphModule(joint_module, fwd_graph)
     bwd_module = fx.GraphModule(joint_module, bwd_graph)
 
@@ -229,26 +307,83 @@ def draw_joint_graph(graph, joint_inputs, file_name="full_graph.png"):
 
 
 def normalize_as_list(x):
-    if isinstance(x, tuple):
-        return list(x)
-    elif isinstance(x, list):
+    # Tuples are returned as is, callers only index and slice the result
+    if isinstance(x, (list, tuple)):
         return x
     return [x]
 
 
-def create_compiled_function(flat_fn, fw_compiler, bw_compiler, partition_fn, decompose):
-
-    # putting these decompositions here since they shouldn't always be used
-    # Kinda sketchy ... we use torch.sub here to have the correct scalar => tensor promotion logic
-    @register_decomposition(aten.rsub)
-    def rsub(a, b, alpha=1):
-        return -aten.sub(a, b)
-
-    # This is only valid if we're running the graph without autograd, such as if the backward pass has been traced.
-    @register_decomposition(aten.detach)
-    def detach_decomposition(x):
-        return x
-
+def _disk_cache_path(fn, flat_args, args_spec, decompose, partition_fn):
+    """
+    Returns the file that the partitioned forward and backward graphs of `fn`
+    are cached in when called with `flat_args`, or None if there is no
+    on-disk cache.
+
+    The on-disk cache is enabled by setting `TORCH_FUNCTORCH_CACHE_DIR`. It is
+    keyed on the source file `fn` is defined in and on the code of
+    `partition_fn`, rather than on a trace of `fn`. So bound methods, closures
+    and functions with default arguments, whose behavior also depends on the
+    state they carry, are never cached. Changes to anything `fn` calls that
+    lives in another file (or to mutable global state) are not detected:
+    clear the cache directory after changing those.
+    """
+    cache_dir = os.environ.get("TORCH_FUNCTORCH_CACHE_DIR")
+    partition_name = getattr(partition_fn, "__qualname__", None)
+    if cache_dir is None or partition_name is None:
+        return None
+    if getattr(fn, "__self__", None) is not None or getattr(fn, "__closure__", None):
+        return None
+    if getattr(fn, "__defaults__", None) or getattr(fn, "__kwdefaults__", None):
+        return None
+    try:
+        from functorch.version import __version__ as functorch_version
+    except ImportError:
+        return None
+    try:
+        source = inspect.getsource(fn)
+        with open(inspect.getsourcefile(fn), "rb") as f:
+            source_file_hash = hashlib.sha1(f.read()).hexdigest()
+        partition_source = inspect.getsource(partition_fn)
+    except (OSError, TypeError):
+        return None
+
+    arg_sig = tuple(
+        (tuple(a.shape), a.dtype, a.device, a.requires_grad) if isinstance(a, torch.Tensor) else repr(a)
+        for a in flat_args
+    )
+    sig = (
+        torch.__version__, functorch_version, fn.__module__, fn.__qualname__, source_file_hash, source,
+        str(args_spec), arg_sig, decompose, partition_fn.__module__, partition_name, partition_source
+    )
+    key = hashlib.sha1(repr(sig).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.pkl")
+
+
+def _load_partition(path):
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # A stale or corrupt entry is treated as a miss, and gets overwritten.
+        return None
+
+
+def _save_partition(path, fw_module, bw_module):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            pickle.dump((fw_module, bw_module), f)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        warnings.warn(f"Failed to write partitioned graphs to {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def create_compiled_function(flat_fn, fw_compiler, bw_compiler, partition_fn, decompose, disk_cache_path=None):
     joint_forward_backward = create_joint_forward_backward(flat_fn)
 
     compiled_fw = None
@@ -267,19 +402,25 @@ def create_compiled_function(flat_fn, fw_compiler, bw_compiler, partition_fn, de
                     num_outs = 1
 
                 joint_inputs = (flat_args, out)
-                with torch.enable_grad():
-                    if decompose:
-                        with pythonkey_decompose():
+                cached_partition = _load_partition(disk_cache_path)
+                if cached_partition is not None:
+                    fw_module, bw_module = cached_partition
+                else:
+                    with torch.enable_grad():
+                        if decompose:
+                            with _aot_autograd_decompose():
+                                fx_g = make_fx(joint_forward_backward)(*joint_inputs)
+                        else:
                             fx_g = make_fx(joint_forward_backward)(*joint_inputs)
-                    else:
-                        fx_g = make_fx(joint_forward_backward)(*joint_inputs)
-                fw_module, bw_module = partition_fn(fx_g, joint_inputs)
+                    fw_module, bw_module = partition_fn(fx_g, joint_inputs)
+                    if disk_cache_path is not None:
+                        _save_partition(disk_cache_path, fw_module, bw_module)
                 # print(fw_module.code, bw_module.code)
 
                 compiled_fw = fw_compiler(fw_module, flat_args)
                 fw_outs = normalize_as_list(compiled_fw(*flat_args))
 
-                bw_args = fw_outs[num_outs:] + fw_outs[0:num_outs]
+                bw_args = list(fw_outs[num_outs:]) + list(fw_outs[0:num_outs])
                 compiled_bw = bw_compiler(bw_module, bw_args)
             fw_outs = normalize_as_list(compiled_fw(*flat_args))
             ctx.save_for_backward(*fw_outs[num_outs:])
@@ -288,10 +429,15 @@ def create_compiled_function(flat_fn, fw_compiler, bw_compiler, partition_fn, de
         @staticmethod
         def backward(ctx, *flat_args):
             # hmm... this doesn't feel right. todo
-            contiguous_args = [t.contiguous() for t in flat_args]
-            out = normalize_as_list(compiled_bw(*ctx.saved_tensors, *contiguous_args))
-            out_iter = iter(out)
-            grad_out = [next(out_iter) if p else None for p in ctx.needs_input_grad]
+            out = normalize_as_list(compiled_bw(*ctx.saved_tensors, *map(torch.Tensor.contiguous, flat_args)))
+            grad_out = []
+            idx = 0
+            for needs_grad in ctx.needs_input_grad:
+                if needs_grad:
+                    grad_out.append(out[idx])
+                    idx += 1
+                else:
+                    grad_out.append(None)
             return tuple(grad_out)
 
     return CompiledFunction
@@ -308,6 +454,94 @@ try:
 except ImportError:
     HAS_TREE = False
 compile_cache = None
+# The functions that compile_cache has entries for, by id. Once one of them is
+# garbage collected its entries are evicted, so that they can't leak or be
+# returned for a different function that ends up with the same id.
+_cached_fns = weakref.WeakValueDictionary()
+
+
+def _evict_compiled_fn(fn_id):
+    if compile_cache is not None:
+        compile_cache.evict(fn_id)
+
+
+def _is_literal_key(k):
+    return type(k) in (str, int)
+
+
+def _gen_flatten(spec, name, lines, leaves):
+    # Each container is bound to a local once, so that neither the checks nor
+    # the leaves re-index all the way from the root.
+    if isinstance(spec, pytree.LeafSpec):
+        lines.append(f"if not isinstance({name}, Tensor): return None")
+        leaves.append(name)
+        return True
+    if spec.type in (tuple, list):
+        num_children = len(spec.children_specs)
+        lines.append(f"if type({name}) is not {spec.type.__name__} or len({name}) != {num_children}: return None")
+        keys = range(num_children)
+    elif spec.type is dict and all(_is_literal_key(k) for k in spec.context):
+        lines.append(f"if type({name}) is not dict or list({name}) != {list(spec.context)!r}: return None")
+        keys = spec.context
+    else:
+        return False
+    for i, (key, child_spec) in enumerate(zip(keys, spec.children_specs)):
+        child_name = f"{name}_{i}"
+        lines.append(f"{child_name} = {name}[{key!r}]")
+        if not _gen_flatten(child_spec, child_name, lines, leaves):
+            return False
+    return True
+
+
+def _gen_unflatten(spec, leaf_idx):
+    if isinstance(spec, pytree.LeafSpec):
+        return f"x[{next(leaf_idx)}]"
+    children = [_gen_unflatten(c, leaf_idx) for c in spec.children_specs]
+    if None in children:
+        return None
+    if spec.type is tuple:
+        return f"({''.join(c + ', ' for c in children)})"
+    if spec.type is list:
+        return f"[{', '.join(children)}]"
+    if spec.type is dict and all(_is_literal_key(k) for k in spec.context):
+        return f"{{{', '.join(f'{k!r}: {c}' for k, c in zip(spec.context, children))}}}"
+    return None
+
+
+def _compile_fn(src, name):
+    namespace = {"Tensor": torch.Tensor}
+    exec(compile(src, f"<{name}>", "exec"), namespace)
+    return namespace[name]
+
+
+def _codegen_flatten(spec):
+    """
+    Generates a function that flattens a pytree of tensors with structure
+    `spec` by indexing into it directly, or returns None if `spec` contains
+    containers other than tuples, lists and dicts.
+
+    The generated function checks that its input actually has structure `spec`
+    and returns None if it doesn't.
+    """
+    lines, leaves = [], []
+    if not _gen_flatten(spec, "x", lines, leaves):
+        return None
+    lines.append(f"return [{', '.join(leaves)}]")
+    src = "def flatten(x):\n" + "".join(f"    {line}\n" for line in lines)
+    return _compile_fn(src, "flatten")
+
+
+def _codegen_unflatten(spec):
+    """
+    Generates a function that rebuilds a pytree with structure `spec` from its
+    leaves, or returns None if `spec` contains containers other than tuples,
+    lists and dicts.
+    """
+    expr = _gen_unflatten(spec, iter(range(spec.num_leaves)))
+    if expr is None:
+        return None
+    return _compile_fn(f"def unflatten(x):\n    return {expr}\n", "unflatten")
+
 
 # Inspired by autodidax (thanks!)
 
@@ -317,6 +551,7 @@ class PytreeThunk:
     # These are some kinda dumb microoptimizations that save about 3-4 us of overhead.
     is_simple = None  # if the output spec is a tuple/list, we won't bother unflattening it.
     is_really_simple = None  # if the output spec is a LeafSpec
+    fast_unflatten = None  # generated by _codegen_unflatten for any other output spec
 
     def set(self, spec):
         assert self.spec is None or self.spec == spec
@@ -325,12 +560,16 @@ class PytreeThunk:
             self.is_simple = True
         if isinstance(self.spec, pytree.LeafSpec):
             self.is_really_simple = True
+        elif self.fast_unflatten is None:
+            self.fast_unflatten = _codegen_unflatten(spec)
 
     def unflatten(self, x):
         if self.is_really_simple:
             return x[0]
         if self.is_simple:
             return x
+        if self.fast_unflatten is not None:
+            return self.fast_unflatten(x)
         return pytree.tree_unflatten(x, self.spec)
 
 
@@ -343,16 +582,34 @@ def compiled_function(
     if bw_compiler is None:
         bw_compiler = fw_compiler
     cached_res = None
+    # Flattens inputs with the same structure as the last compiled call,
+    # when dm-tree isn't available.
+    fast_flatten = None
 
     fn_id = id(fn)
+    # The compiled functions in compile_cache only hold on to fn weakly so that
+    # it can be collected; returned_function.__wrapped__ is what keeps it alive.
+    try:
+        fn_ref = weakref.ref(fn)
+        if fn_id not in _cached_fns:
+            _cached_fns[fn_id] = fn
+            # Eviction only matters while the process keeps running, so don't
+            # scan the cache for every live fn at interpreter shutdown
+            weakref.finalize(fn, _evict_compiled_fn, fn_id).atexit = False
+    except TypeError:
+        # fn doesn't support weak references, so it lives as long as its entries
+        def fn_ref():
+            return fn
 
     def returned_function(*args, **kwargs):
         global compile_cache
-        nonlocal cached_res
-        if HAS_TREE:
-            flattened_args = tree.flatten((args, kwargs))
-        else:
-            flattened_args, _ = pytree.tree_flatten((args, kwargs))
+        nonlocal cached_res, fast_flatten
+        flattened_args = fast_flatten((args, kwargs)) if fast_flatten is not None else None
+        if flattened_args is None:
+            if HAS_TREE:
+                flattened_args = tree.flatten((args, kwargs))
+            else:
+                flattened_args, _ = pytree.tree_flatten((args, kwargs))
         num_args = len(flattened_args)
         # Check if the fn is already compiled
         cached_res = compile_cache.at(fn_id, num_args, hasher_type, *flattened_args)
@@ -361,17 +618,24 @@ def compiled_function(
         if cached_res is None:
             # Compile a new function
             flattened_args, args_spec = pytree.tree_flatten((args, kwargs))
+            # dm-tree's C++ flatten is already fast, so only pytree gets replaced
+            if not HAS_TREE:
+                fast_flatten = _codegen_flatten(args_spec)
             out_spec = PytreeThunk()
 
+            live_fn = fn_ref()
+            assert live_fn is not None, "compiled_function's fn was garbage collected"
+
             def flat_fn(*args):
                 nonlocal out_spec
                 args, kwargs = pytree.tree_unflatten(args, args_spec)
-                tree_out = fn(*args, **kwargs)
+                tree_out = fn_ref()(*args, **kwargs)
                 flat_out = pytree.tree_flatten(tree_out)
                 out_spec.set(flat_out[1])
                 return flat_out[0]
+            disk_cache_path = _disk_cache_path(live_fn, flattened_args, args_spec, decompose, partition_fn)
             compiled_fn = create_compiled_function(
-                flat_fn, fw_compiler, bw_compiler, partition_fn, decompose
+                flat_fn, fw_compiler, bw_compiler, partition_fn, decompose, disk_cache_path
             ).apply
             cached_res = (compiled_fn, out_spec)
             # Save the compiled_fn in the cache
@@ -383,6 +647,7 @@ def compiled_function(
         out = cached_fn(*flattened_args)
         return out_spec.unflatten(out)
 
+    returned_function.__wrapped__ = fn
     return returned_function
 
 
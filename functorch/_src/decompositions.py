@@ -8,9 +8,12 @@ aten = torch.ops.aten
 decomposition_table = {}
 
 
-def register_decomposition(aten_op):
+def register_decomposition(aten_op, registry=None):
+    if registry is None:
+        registry = decomposition_table
+
     def decomposition_decorator(f):
-        decomposition_table[aten_op] = f
+        registry[aten_op] = f
         return f
     return decomposition_decorator
 
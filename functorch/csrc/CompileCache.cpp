@@ -202,6 +202,23 @@ public:
     cache_.emplace(cacheKey, compileFn);
   }
 
+  /// Remove all the compiled functions for the function with the given id.
+  void evict(int64_t id) {
+    // Hold on to the evicted functions until we're done iterating, since
+    // releasing them can run arbitrary Python code.
+    std::vector<py::object> evicted;
+    for (auto it = cache_.begin(); it != cache_.end();) {
+      // computeCacheKey appends the id followed by the number of args.
+      const hash_key_t &key = it->first;
+      if (key[key.size() - 2] == id) {
+        evicted.push_back(std::move(it->second));
+        it = cache_.erase(it);
+      } else {
+        ++it;
+      }
+    }
+  }
+
   const int64_t size() const { return cache_.size(); }
 
   /// Clear the cache.
@@ -235,6 +252,7 @@ void initCompileCacheBindings(PyObject *module) {
               py::args args, py::kwargs kwargs) {
              self.insert(id, numArgs, hasherType, compileFn, args.ptr());
            })
+      .def("evict", [](CompileCache &self, int64_t id) { self.evict(id); })
       .def("clear", [](CompileCache &self) { self.clear(); })
       .def("size", [](CompileCache &self) { return self.size(); });
 }
@@ -1,3 +1,4 @@
+import gc
 import torch
 
 import functorch
@@ -215,6 +216,25 @@ class TestCompileCache(TestCase):
             args = [torch.randn(10, requires_grad=True) for _ in range(100)]
             check(args, aot_autograd_f, f)
 
+    def test_eviction_on_fn_deletion(self):
+        def f(x):
+            return x.sin()
+
+        def _nop_compile(x, _):
+            return x
+
+        functorch.compile.clear_compile_cache()
+        aot_autograd_f = compiled_function(f, _nop_compile, _nop_compile)
+        aot_autograd_f(torch.randn(10, requires_grad=True)).sum().backward()
+        assert functorch.compile.num_of_recompilations() == 1
+
+        # Needs a _C extension built with CompileCache.evict. With an older
+        # build the finalizer's AttributeError is only printed, and this fails
+        # on the assert below instead.
+        del f, aot_autograd_f
+        gc.collect()
+        assert functorch.compile.num_of_recompilations() == 0
+
 
 if __name__ == "__main__":
     run_tests()
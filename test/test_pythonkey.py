@@ -8,7 +8,10 @@ from torch.testing._internal.common_utils import TestCase, run_tests
 import torch
 import torch.nn as nn
 import torch.utils._pytree as pytree
+import os
+import tempfile
 import unittest
+from unittest.mock import patch
 import warnings
 from torch.testing._internal.common_device_type import instantiate_device_type_tests
 from functorch import (
@@ -17,7 +20,8 @@ from functorch import (
 )
 from functorch.compile import (
     nnc_jit, compiled_function, compiled_module,
-    partition_with_recompute_fwd_in_bwd, pythonkey_decompose, aot_function, aot_module
+    partition_with_recompute_fwd_in_bwd, pythonkey_decompose, aot_function, aot_module,
+    default_partition, clear_compile_cache
 )
 
 from torch.testing._internal.common_device_type import ops
@@ -291,6 +295,24 @@ class TestAOTAutograd(TestCase):
         inp = [{'a': torch.randn(3, requires_grad=True), 'b': torch.randn(3, requires_grad=True)}]
         self.verify_aot_autograd(f, inp)
 
+    def test_nested_input_output(self):
+        def f(x, ys, scale):
+            return {'a': [x * scale['s']], 'b': (ys[0] + ys[1], x.sin())}
+
+        def f_kwargs(x, ys, scale):
+            return compiled_f(x, ys, scale=scale)
+
+        compiled_f = aot_function(f, _nop_compile, _nop_compile)
+        # Switching between input structures has to fall back to the generic
+        # flatten instead of reusing the one generated for the previous call
+        for size, call in [(3, compiled_f), (3, compiled_f), (4, f_kwargs), (3, compiled_f), (4, f_kwargs)]:
+            x, y0, y1, s = [torch.randn(size, requires_grad=True) for _ in range(4)]
+            inp = [x, (y0, y1) if call is f_kwargs else [y0, y1], {'s': s}]
+            ref_out, ref_grad = _outs_and_grads(f, inp)
+            test_out, test_grad = _outs_and_grads(call, inp)
+            self.assertEqual(ref_out, test_out)
+            self.assertEqual(ref_grad, test_grad)
+
     def test_module(self):
         mod = nn.Sequential(nn.Linear(32, 32), nn.ReLU())
         compiled_mod = compiled_module(mod, _nop_compile, _nop_compile)
@@ -308,6 +330,63 @@ class TestAOTAutograd(TestCase):
         x = torch.ones(1, 4, 2, 2)
         mod(x).sum().backward()
 
+    def test_disk_cache(self):
+        def f(a, b):
+            return a.sin() * b
+
+        num_partitions = 0
+
+        def partition(joint_module, joint_inputs):
+            nonlocal num_partitions
+            num_partitions += 1
+            return default_partition(joint_module, joint_inputs)
+
+        inp = [torch.randn(3, 3, requires_grad=True), torch.randn(3, 3)]
+        ref_out, ref_grad = _outs_and_grads(f, inp)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict(os.environ, {"TORCH_FUNCTORCH_CACHE_DIR": cache_dir}):
+                for _ in range(2):
+                    clear_compile_cache()
+                    compiled_f = aot_function(f, _nop_compile, _nop_compile, partition_fn=partition)
+                    test_out, test_grad = _outs_and_grads(compiled_f, inp)
+                    self.assertEqual(ref_out, test_out)
+                    self.assertEqual(ref_grad, test_grad)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertEqual(num_partitions, 1)
+
+    def test_disk_cache_closures(self):
+        def make(act):
+            def f(x):
+                return act(x)
+            return f
+
+        inp = [torch.randn(3, requires_grad=True)]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict(os.environ, {"TORCH_FUNCTORCH_CACHE_DIR": cache_dir}):
+                for act in [torch.sin, torch.cos]:
+                    clear_compile_cache()
+                    f = make(act)
+                    ref_out, ref_grad = _outs_and_grads(f, inp)
+                    test_out, test_grad = _outs_and_grads(aot_function(f, _nop_compile, _nop_compile), inp)
+                    self.assertEqual(ref_out, test_out)
+                    self.assertEqual(ref_grad, test_grad)
+            # Closures carry state that their source doesn't show, so they're never cached
+            self.assertEqual(os.listdir(cache_dir), [])
+
+    def test_disk_cache_default_args(self):
+        inp = [torch.randn(3, requires_grad=True)]
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with patch.dict(os.environ, {"TORCH_FUNCTORCH_CACHE_DIR": cache_dir}):
+                for k in (2, 3):
+                    clear_compile_cache()
+                    f = lambda x, k=k: x * k  # noqa: E731
+                    ref_out, ref_grad = _outs_and_grads(f, inp)
+                    test_out, test_grad = _outs_and_grads(aot_function(f, _nop_compile, _nop_compile), inp)
+                    self.assertEqual(ref_out, test_out)
+                    self.assertEqual(ref_grad, test_grad)
+            # Default arguments aren't part of the source either
+            self.assertEqual(os.listdir(cache_dir), [])
+
 
 class TestEagerFusionOpInfo(TestCase):
     @ops(functorch_lagging_op_db + additional_op_db, allowed_dtypes=(torch.float,))
@@ -391,6 +470,54 @@ class TestEagerFusionOpInfo(TestCase):
 
 
 class TestPartitioning(TestCase):
+    def num_fw_outputs(self, fn, inps, partition_fn):
+        # Returns the outputs of fn compiled with partition_fn, and how many
+        # values its forward graph returns (real outputs + saved values).
+        num_outputs = None
+
+        def fw_compiler(fx_g, example_inputs):
+            nonlocal num_outputs
+            out = fx_g(*example_inputs)
+            num_outputs = len(out) if isinstance(out, (list, tuple)) else 1
+            return fx_g
+
+        compiled_fn = compiled_function(fn, fw_compiler, _nop_compile, partition_fn)
+        return compiled_fn(*inps), num_outputs
+
+    def test_default_partition_saved_values(self):
+        def fn(x):
+            return torch.sin(x) * x
+
+        inp = torch.randn(10, requires_grad=True)
+        out, num_fw_outputs = self.num_fw_outputs(fn, [inp], default_partition)
+        self.assertEqual(out, fn(inp))
+        # The output, plus x and sin(x) saved for the backward. cos(x) only
+        # uses saved values, so it is recomputed in the backward.
+        self.assertEqual(num_fw_outputs, 3)
+
+    def test_recompute_partitioning_unused_saved_values(self):
+        def fn(a, b):
+            return a.sin() + b
+
+        inps = [torch.randn(10, requires_grad=True), torch.randn(10, requires_grad=True)]
+        out, num_fw_outputs = self.num_fw_outputs(fn, inps, partition_with_recompute_fwd_in_bwd)
+        self.assertEqual(out, fn(*inps))
+        # The backward only needs a (for cos(a)), so b isn't saved
+        self.assertEqual(num_fw_outputs, 2)
+
+    def test_recompute_partitioning_no_grad(self):
+        def fn(a, b):
+            return torch.sin(a) * b
+
+        inps = [torch.randn(10), torch.randn(10)]
+        with patch("functorch._src.aot_autograd.default_partition", wraps=default_partition) as mock_partition:
+            out, num_fw_outputs = self.num_fw_outputs(fn, inps, partition_with_recompute_fwd_in_bwd)
+        self.assertEqual(out, fn(*inps))
+        # Without a backward there is nothing to recompute, so this falls back
+        # to default_partition, and the forward returns only the real output
+        mock_partition.assert_called_once()
+        self.assertEqual(num_fw_outputs, 1)
+
     def test_recompute_partitioning(self):
         def fn(a, b):
             return torch.sin(torch.sin(a)) + b